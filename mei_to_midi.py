@@ -2,83 +2,146 @@ import os
 import sys
 import argparse
 import traceback
-from music21 import converter, midi
-import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from music21 import mei, midi
+from lxml import etree as ET
 import re
+from io import BytesIO
+from itertools import chain
+
+# Namespaced (Clark notation) tags of the MEI elements we sanitize
+MEI_NS = '{http://www.music-encoding.org/ns/mei}'
+SYL_TAG, VERSE_TAG, MEASURE_TAG = MEI_NS + 'syl', MEI_NS + 'verse', MEI_NS + 'measure'
+
+# Matches measure numbers that int() would accept
+_INT_RE = re.compile(r'\s*[-+]?\d+\s*')
+
+# Cheap byte-level checks for content that remove_lyrics_from_mei would change
+_LYRICS_RE = re.compile(rb'<(?:\w+:)?(?:verse|syl)\b')
+_MEASURE_TAG_RE = re.compile(rb'<(?:\w+:)?measure\b((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+_ATTR_RE = re.compile(rb'([^\s=]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_INT_BYTES_RE = re.compile(rb'\s*[-+]?\d+\s*')
+
+# Byte order marks of encodings the byte-level checks can't see into
+_WIDE_BOMS = (b'\xff\xfe', b'\xfe\xff', b'\x00\x00\xfe\xff')
+
+# Print full tracebacks for failed files; set from --verbose in main()
+VERBOSE = False
+
+def _is_ascii_compatible(raw):
+    """
+    Check whether raw MEI bytes are in an ASCII-compatible encoding, so that
+    markup can be found with byte-level searches. UTF-16 and UTF-32 files
+    (e.g. as written by Sibelius's sibmei exporter) are not
+    
+    Parameters:
+    raw (bytes): The MEI XML content
+    
+    Returns:
+    bool: False if raw starts with a UTF-16/UTF-32 byte order mark or has
+    NUL bytes among its first few bytes
+    """
+    return not raw.startswith(_WIDE_BOMS) and b'\x00' not in raw[:4]
+
+def _has_bad_measure_number(raw):
+    """
+    Check raw MEI bytes for a measure number that isn't an integer
+    
+    Parameters:
+    raw (bytes): The MEI XML content
+    
+    Returns:
+    bool: True if any measure has a non-integer 'n' attribute
+    """
+    for tag in _MEASURE_TAG_RE.finditer(raw):
+        for attr in _ATTR_RE.finditer(tag.group(1)):
+            if attr.group(1) != b'n':
+                continue
+            measure_num = attr.group(2) if attr.group(2) is not None else attr.group(3)
+            if measure_num and not _INT_BYTES_RE.fullmatch(measure_num):
+                return True
+    return False
 
 def remove_lyrics_from_mei(mei_data):
     """
     Remove all lyrics elements from MEI XML data and sanitize measure numbers
     
     Parameters:
-    mei_data (str): The MEI XML content as a string
+    mei_data (bytes or str): The MEI XML content
     
     Returns:
-    str: The MEI XML with lyrics removed and measure numbers sanitized
+    bytes or str: The MEI XML with lyrics removed and measure numbers sanitized,
+    of the same type as mei_data
     """
+    # Skip the parse/serialize round trip for files with nothing to sanitize
+    raw = mei_data.encode('utf-8') if isinstance(mei_data, str) else mei_data
+    if (_is_ascii_compatible(raw) and not _LYRICS_RE.search(raw)
+            and not _has_bad_measure_number(raw)):
+        return mei_data
+    
     try:
-        # Parse the XML
-        root = ET.fromstring(mei_data)
-        
-        # Define namespace (found in the root element)
-        ns = {'mei': 'http://www.music-encoding.org/ns/mei'}
-        
-        # Handle syllable types that music21 might not understand
-        for syl in root.findall('.//mei:syl', ns):
-            wordpos = syl.get('wordpos')
-            if wordpos in ['s', 'i', 'm', 't']:  # These are standard MEI values
-                continue
-            elif wordpos == 'u':  # Unknown/unclear
-                syl.set('wordpos', 'i')  # Treat as intermediate
+        # Stream through the XML in a single pass, handling each element once
+        # its subtree is complete (lxml requires bytes when an encoding
+        # declaration is present). Recover mode parses around minor XML
+        # errors common in scraped corpora, and huge_tree lifts libxml2's
+        # size limits for very large scores
+        measures_seen = {}  # parent element -> number of child measures so far
+        context = ET.iterparse(BytesIO(raw), events=('end',),
+                               tag=(SYL_TAG, VERSE_TAG, MEASURE_TAG),
+                               recover=True, huge_tree=True)
+        for event, elem in context:
+            if elem.tag == SYL_TAG:
+                # Handle syllable types that music21 might not understand
+                wordpos = elem.get('wordpos')
+                if wordpos in ['s', 'i', 'm', 't']:  # These are standard MEI values
+                    continue
+                elif wordpos == 'u':  # Unknown/unclear
+                    elem.set('wordpos', 'i')  # Treat as intermediate
+                else:
+                    elem.set('wordpos', 's')  # Default to single
+            
+            elif elem.tag == VERSE_TAG:
+                # Remove the verse element (and its children) from its parent
+                # note, freeing its subtree as soon as it has been parsed
+                parent_note = elem.getparent()
+                if parent_note is not None:
+                    parent_note.remove(elem)
+            
             else:
-                syl.set('wordpos', 's')  # Default to single
-        
-        # Find and remove all verse elements (and their children)
-        for verse in root.findall('.//mei:verse', ns):
-            # Find parent note
-            parent_note = None
-            for ancestor in root.iter():
-                if verse in list(ancestor):
-                    parent_note = ancestor
-                    break
-            if parent_note is not None:
-                parent_note.remove(verse)
-        
-        # Sanitize measure numbers
-        for measure in root.findall('.//mei:measure', ns):
-            measure_num = measure.get('n')
-            if measure_num:
-                try:
-                    # Try to convert to integer
-                    int(measure_num)
-                except ValueError:
-                    # If conversion fails, replace with a valid number
+                # Track the measure's position among its siblings, all of
+                # which precede it at this point in the stream
+                parent = elem.getparent()
+                measure_index = measures_seen.get(parent, 0)
+                measures_seen[parent] = measure_index + 1
+                
+                # Sanitize measure numbers
+                measure_num = elem.get('n')
+                if measure_num and not _INT_RE.fullmatch(measure_num):
+                    # If it isn't an integer, replace with a valid number
                     # Here we'll use the measure's position among its siblings
-                    parent = None
-                    for ancestor in root.iter():
-                        if measure in list(ancestor):
-                            parent = ancestor
-                            break
                     if parent is not None:
-                        sibling_measures = parent.findall('mei:measure', ns)
-                        measure_index = sibling_measures.index(measure)
-                        measure.set('n', str(measure_index))
+                        elem.set('n', str(measure_index))
         
-        # Convert back to string
-        return ET.tostring(root, encoding='utf-8').decode('utf-8')
+        root = context.root
+        
+        # Serialize back to UTF-8 bytes, decoding only if a string was given
+        mei_bytes = ET.tostring(root, encoding='utf-8')
+        return mei_bytes.decode('utf-8') if isinstance(mei_data, str) else mei_bytes
     
     except Exception as e:
         print(f"Error processing MEI data: {str(e)}")
-        traceback.print_exc()
+        if VERBOSE:
+            traceback.print_exc()
         return mei_data  # Return original if processing failed
 
-def convert_mei_to_midi(input_file, output_file=None):
+def convert_mei_to_midi(input_file, output_file=None, mei_data=None):
     """
     Convert an MEI file to MIDI format using music21, after removing lyrics
     
     Parameters:
     input_file (str): Path to the MEI file
     output_file (str): Path to save the MIDI file. If None, replaces .mei with .mid
+    mei_data (bytes): Already-read content of input_file. If None, the file is read here
     
     Returns:
     str: Path to the output file if successful, None otherwise
@@ -90,76 +153,89 @@ def convert_mei_to_midi(input_file, output_file=None):
         
         print(f"Converting {input_file} to MIDI...")
         
-        # Read the MEI file
-        with open(input_file, 'r', encoding='utf-8') as f:
-            mei_data = f.read()
+        # Read the MEI file unless the caller already has it; it stays as bytes all
+        # the way into music21 to avoid decoding and copying the document
+        if mei_data is None:
+            mei_data = _read_file(input_file)
         
         # Remove lyrics
         mei_data_no_lyrics = remove_lyrics_from_mei(mei_data)
         
-        # Write to a temporary file with .mei extension
-        temp_file = input_file + '.temp.mei'
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            f.write(mei_data_no_lyrics)
+        # Parse with music21's MEI importer directly from the sanitized bytes
+        # (converter.parseData only accepts MEI as str)
+        score = mei.MeiToM21Converter(mei_data_no_lyrics).run()
         
-        # Parse with music21
-        try:
-            score = converter.parse(temp_file, format='mei')
-            
-            # Create a new MIDI file manually to bypass repeat expansion
-            try:
-                mf = midi.MidiFile()
-                mt = midi.MidiTrack(0)
-                mf.tracks.append(mt)
-                
-                # Add tempo events if they exist
-                for t in score.flat.getElementsByClass('TempoIndication'):
-                    mt.events.append(midi.MidiEvent(
-                        track=0,
-                        time=0,
-                        type='SET_TEMPO',
-                        data=midi.translate.tempoToMidiEvents(t)[0].data
-                    ))
-                
-                # Add all notes to the track
-                for n in score.flat.notesAndRests:
-                    # Skip rests for this simple conversion
-                    if n.isRest:
-                        continue
-                        
-                    # Convert note to MIDI events
-                    for midi_note in midi.translate.noteToMidiEvents(n):
-                        mt.events.append(midi_note)
-                
-                # Write the MIDI file
-                mf.open(output_file, 'wb')
-                mf.write()
-                mf.close()
-                
-                print(f"Successfully converted to {output_file}")
-                result = output_file
-                
-            except Exception as e:
-                print(f"MIDI creation error: {str(e)}")
-                traceback.print_exc()
-                result = None
-                
-        except Exception as e:
-            print(f"Music21 conversion error: {str(e)}")
-            traceback.print_exc()
-            result = None
+        # Create a new MIDI file manually to bypass repeat expansion
+        mf = midi.MidiFile()
+        mt = midi.MidiTrack(0)
+        mf.tracks.append(mt)
+        
+        # Flatten the score once and reuse it for tempos and notes
+        flat = score.flatten()
+        
+        # Add tempo events if they exist, encoding the 3-byte
+        # microseconds-per-quarter value directly
+        for t in flat.getElementsByClass('TempoIndication'):
+            mm = t.getSoundingMetronomeMark()
+            if mm is None or not mm.getQuarterBPM():
+                continue  # e.g. a metric modulation without a number
+            # Clamp to the largest value that fits in 3 bytes (~3.58 BPM)
+            us_per_quarter = min(int(round(60_000_000 / mm.getQuarterBPM())), 0xFFFFFF)
+            tempo_event = midi.MidiEvent(track=mt, type=midi.MetaEvents.SET_TEMPO)
+            tempo_event.data = us_per_quarter.to_bytes(3, 'big')
+            mt.events.append(midi.DeltaTime(track=mt))
+            mt.events.append(tempo_event)
         
-        # Clean up temporary file
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+        # Add all notes to the track (rests are skipped for this
+        # simple conversion), converting each note to MIDI events and
+        # concatenating them onto the track in one go
+        note_events = [midi.translate.noteToMidiEvents(n) for n in flat.notes]
+        mt.events.extend(chain.from_iterable(note_events))
         
-        return result
+        # Serialize the MIDI data in memory and write the file in one go
+        with open(output_file, 'wb') as f:
+            f.write(mf.writestr())
+        
+        print(f"Successfully converted to {output_file}")
+        return output_file
     
     except Exception as e:
         print(f"Error processing {input_file}: {str(e)}")
-        traceback.print_exc()
+        if VERBOSE:
+            traceback.print_exc()
         return None
 
+def _read_file(path):
+    """
+    Read a file's raw bytes
+    
+    Parameters:
+    path (str): Path to the file
+    
+    Returns:
+    bytes: The file content
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _set_verbose(verbose):
+    """
+    Set the module-level VERBOSE flag. Also used as the ProcessPoolExecutor
+    initializer so worker processes honour --verbose under any start method
+    
+    Parameters:
+    verbose (bool): Whether to print full tracebacks for failed files
+    """
+    global VERBOSE
+    VERBOSE = verbose
+
+def _convert_star(args):
+    """
+    Unpack an (input_file, output_file) pair for convert_mei_to_midi.
+    Defined at module level so it can be pickled by ProcessPoolExecutor.
+    """
+    return convert_mei_to_midi(*args)
+
 def process_directory(input_dir, output_dir=None):
     """
     Process all MEI files in a directory
@@ -179,25 +255,32 @@ def process_directory(input_dir, output_dir=None):
     if output_dir and not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    success_count = 0
-    failed_count = 0
+    # Collect each MEI file in directory
+    args_list = []
+    with os.scandir(input_dir) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith('.mei'):
+                input_path = entry.path
+                
+                if output_dir:
+                    output_filename = os.path.splitext(entry.name)[0] + '.mid'
+                    output_path = os.path.join(output_dir, output_filename)
+                else:
+                    output_path = None  # Will use default naming in convert function
+                
+                args_list.append((input_path, output_path))
     
-    # Process each MEI file in directory
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith('.mei'):
-            input_path = os.path.join(input_dir, filename)
-            
-            if output_dir:
-                output_filename = os.path.splitext(filename)[0] + '.mid'
-                output_path = os.path.join(output_dir, output_filename)
-            else:
-                output_path = None  # Will use default naming in convert function
-            
-            result = convert_mei_to_midi(input_path, output_path)
-            if result:
-                success_count += 1
-            else:
-                failed_count += 1
+    # Convert files in parallel; processes rather than threads since
+    # music21 parsing is CPU-bound and holds the GIL. Each worker reads its
+    # own file, so reads in one process overlap with parsing in the others
+    # without the parent holding or pickling any file contents
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             initializer=_set_verbose,
+                             initargs=(VERBOSE,)) as ex:
+        results = list(ex.map(_convert_star, args_list))
+    
+    success_count = sum(1 for result in results if result)
+    failed_count = len(results) - success_count
     
     print(f"Conversion complete: {success_count} succeeded, {failed_count} failed")
     return success_count
@@ -209,6 +292,7 @@ def main():
     parser.add_argument('--verbose', action='store_true', help='Enable verbose error output')
     
     args = parser.parse_args()
+    _set_verbose(args.verbose)
     
     if os.path.isdir(args.input):
         # Process directory